@@ -4,36 +4,78 @@
 import os as _os
 import subprocess
 import sys
-import re
-import argparse
 
 import datetime
-
-class WrappedOS(object):
-    str_funcs = ('getenv', 'getcwd',)
-
-    def __init__(self):
-        self.os = _os
-
-    def __getattr__(self, name):
-        if not sys.version_info >= (3, 0) and name in WrappedOS.str_funcs:
-            def wrapped(*args, **kwargs):
-                orig = self.os.__getattribute__(name)
-                swag=orig(*args, **kwargs)
-                if swag is not None:
-                    return swag.decode('utf-8')
-                else:
-                    return None
-            return wrapped
-        return self.os.__getattribute__(name)
-
-os = WrappedOS()
+import io
+import stat
+import time
+import zlib
+
+if sys.version_info >= (3, 0):
+    # Python 3 already hands out str, so use the os module as is
+    os = _os
+else:
+    class WrappedOS(object):
+        str_funcs = ('getenv', 'getcwd',)
+
+        def __init__(self):
+            self.os = _os
+
+        def __getattr__(self, name):
+            if name in WrappedOS.str_funcs:
+                def wrapped(*args, **kwargs):
+                    orig = self.os.__getattribute__(name)
+                    swag=orig(*args, **kwargs)
+                    if swag is not None:
+                        return swag.decode('utf-8')
+                    else:
+                        return None
+                return wrapped
+            return self.os.__getattribute__(name)
+
+    os = WrappedOS()
+
+HOME = os.getenv('HOME')
 
 
 def warn(msg):
     print('[powerline-shell] ', msg)
 
 
+# Seconds a cached repo segment stays valid while its fingerprint matches.
+# Worktree edits don't touch any metadata file, so this bounds how long a
+# freshly dirtied tree can still show up as clean.
+REPO_CACHE_TTL = 5
+
+# Metadata files, relative to the VCS directory, whose stat is folded into
+# the repo fingerprint. For git, packed-refs and the checked out branch's
+# ref are added from the common dir, which linked worktrees share.
+VCS_FINGERPRINT_FILES = {
+    'git': ('index', 'HEAD'),
+    'hg': ('dirstate', 'branch', 'bookmarks.current'),
+    'svn': ('wc.db',),
+}
+
+# gitstatusd keeps each repository's index in memory between prompts. We
+# talk to it through a small bridge process listening on a Unix socket.
+GITSTATUSD_COMMAND = ['gitstatusd', '-s', '-1', '-u', '-1', '-c', '-1',
+        '-d', '-1']
+GITSTATUSD_TIMEOUT = 2
+# The bridge gives a live gitstatusd this long to answer. Its first scan of
+# a big repository can take far longer than a prompt waits, and letting it
+# finish is what makes the next prompts fast.
+GITSTATUSD_REPLY_TIMEOUT = 600
+# The bridge and its gitstatusd exit after this many idle seconds.
+GITSTATUSD_IDLE_TIMEOUT = 3600
+
+# With --async, seconds to wait for the repo segment before drawing a
+# placeholder and repainting the prompt once the VCS commands finish.
+ASYNC_REPO_TIMEOUT = 0.1
+
+# With --serve, seconds a client gets to send its request.
+SERVE_CLIENT_TIMEOUT = 2
+
+
 class Color:
     # The following link is a pretty good resources for color values:
     # http://www.calmar.ws/vim/color-output.png
@@ -68,6 +110,19 @@ class Color:
     VIRTUAL_ENV_FG = 00
 
 
+class ColorEscapes(dict):
+    """ Maps color codes to their escape sequence, formatting each code the
+        first time it's looked up.
+    """
+    def __init__(self, powerline, prefix):
+        self.powerline = powerline
+        self.prefix = prefix
+
+    def __missing__(self, code):
+        escape = self[code] = self.powerline.color(self.prefix, code)
+        return escape
+
+
 class Powerline:
     symbols = {
         'compatible': {
@@ -109,15 +164,17 @@ class Powerline:
         self.segments_right = []
         self.segments_down = []
         self.width=width
+        self.fgcolors = ColorEscapes(self, '38')
+        self.bgcolors = ColorEscapes(self, '48')
 
     def color(self, prefix, code):
         return self.color_template % ('[%s;5;%sm' % (prefix, code))
 
     def fgcolor(self, code):
-        return self.color('38', code)
+        return self.fgcolors[code]
 
     def bgcolor(self, code):
-        return self.color('48', code)
+        return self.bgcolors[code]
 
     def append(self, segment):
         self.segments.append(segment)
@@ -130,23 +187,25 @@ class Powerline:
 
     def draw(self):
         shifted = self.segments[1:] + [None]
-        shifted_right = self.segments_right[1:] + [None]
+        right_pairs = list(zip(self.segments_right, self.segments_right[1:] + [None]))[::-1]
         shifted_down = self.segments_down[1:] + [None]
 
         total=0
-        total+=sum(c.width() for c in self.segments)
-        total+=sum(c.width() for c in self.segments_right)
+        total+=sum(c._width for c in self.segments)
+        total+=sum(c._width for c in self.segments_right)
 
         spaces=int(self.width)-total
         fold=' ' * spaces
-        
-        return (
-            ''.join((c.draw(n) for c, n in zip(self.segments, shifted)))
-            + self.reset + fold + ''.join((c.draw(n) for c, n in zip(reversed(self.segments_right), reversed(shifted_right))))
-            + self.reset + "\n" + ''.join((c.draw(n) for c, n in zip(self.segments_down, shifted_down)))
-            + self.reset
 
-        )
+        parts = [c.draw(n) for c, n in zip(self.segments, shifted)]
+        parts.append(self.reset)
+        parts.append(fold)
+        parts.extend(c.draw(n) for c, n in right_pairs)
+        parts.append(self.reset)
+        parts.append("\n")
+        parts.extend(c.draw(n) for c, n in zip(self.segments_down, shifted_down))
+        parts.append(self.reset)
+        return ''.join(parts)
 
 
 class Segment:
@@ -159,62 +218,65 @@ class Segment:
         self.separator = separator or powerline.separator
         self.separator_fg = separator_fg or bg
         self.right=right
+        self._width = len(self.content) + len(self.separator)
 
     def width(self):
-        return len(''.join((
-            self.content,
-            self.separator)))
+        return self._width
 
     def draw(self, next_segment=None):
+        fgcolors = self.powerline.fgcolors
+        bgcolors = self.powerline.bgcolors
         if next_segment:
-            separator_bg = self.powerline.bgcolor(next_segment.bg)
+            separator_bg = bgcolors[next_segment.bg]
         else:
             separator_bg = self.powerline.reset
 
         if self.right == True:
             return ''.join((
                 separator_bg,
-                self.powerline.fgcolor(self.separator_fg),
+                fgcolors[self.separator_fg],
                 self.separator,
-                self.powerline.fgcolor(self.fg),
-                self.powerline.bgcolor(self.bg),
+                fgcolors[self.fg],
+                bgcolors[self.bg],
                 self.content
                 
                 ))
 
         return ''.join((
-            self.powerline.fgcolor(self.fg),
-            self.powerline.bgcolor(self.bg),
+            fgcolors[self.fg],
+            bgcolors[self.bg],
             self.content,
             separator_bg,
-            self.powerline.fgcolor(self.separator_fg),
+            fgcolors[self.separator_fg],
             self.separator))
 
 
-def add_cwd_segment(powerline, cwd, maxdepth, cwd_only=False):
+def add_cwd_segment(powerline, cwd, maxdepth, cwd_only=False, home=HOME):
     #powerline.append(' \\w ', 15, 237)
-    home = os.getenv('HOME')
     cwd = cwd or os.getenv('PWD')
     #cwd = cwd.decode('utf-8')
 
-    if cwd.find(home) == 0:
-        cwd = cwd.replace(home, '~', 1)
+    # Only a whole path component: /home/alice isn't under HOME=/home/al
+    if home and (cwd == home or cwd.startswith(home + '/')):
+        cwd = '~' + cwd[len(home):]
 
-    if cwd[0] == '/':
+    if cwd.startswith('/'):
         cwd = cwd[1:]
 
     names = cwd.split('/')
     if len(names) > maxdepth:
-        names = names[:2] + [u'\u2026'] + names[2 - maxdepth:]
+        # Keep the first two and the last maxdepth - 2 names
+        names = names[:2] + [u'\u2026'] + names[len(names) - (maxdepth - 2):]
 
     if not cwd_only:
-        for n in range(len(names[:-1])):
+        last = len(names) - 2
+        for n, name in enumerate(names[:-1]):
             sep=powerline.separator_thin
             sepc=Color.SEPARATOR_FG
-            if n == len(names)-2:
+            if n == last:
                 sep=powerline.separator
                 sepc=Color.PATH_BG
-            powerline.append(Segment(powerline, ' %s ' % names[n], Color.PATH_FG,
+            powerline.append(Segment(powerline, ' %s ' % name, Color.PATH_FG,
                 Color.PATH_BG, sep, sepc))
     powerline.append(Segment(powerline, ' %s ' % names[-1], Color.CWD_FG,
         Color.CWD_BG))
@@ -238,13 +300,24 @@ def get_hg_status():
     return has_modified_files, has_untracked_files, has_missing_files
 
 
-def add_hg_segment(powerline, cwd):
-    branch = os.popen('hg branch 2> /dev/null').read().rstrip()
-    if len(branch) == 0:
-        return False
+def get_hg_segment(powerline, cwd, root):
+    try:
+        with io.open(os.path.join(root, '.hg', 'branch'),
+                encoding='utf-8') as f:
+            branch = f.read().strip() or 'default'
+    except IOError:
+        # Mercurial only writes the file once you leave the default branch
+        branch = 'default'
     bg = Color.REPO_CLEAN_BG
     fg = Color.REPO_CLEAN_FG
-    has_modified_files, has_untracked_files, has_missing_files = get_hg_status()
+    has_modified_files = has_untracked_files = has_missing_files = False
+    if os.getenv('POWERLINE_HG_STATUS'):
+        # Running hg costs a Mercurial startup, so it's opt-in
+        try:
+            has_modified_files, has_untracked_files, has_missing_files = \
+                    get_hg_status()
+        except OSError:
+            pass
     if has_modified_files or has_untracked_files or has_missing_files:
         bg = Color.REPO_DIRTY_BG
         fg = Color.REPO_DIRTY_FG
@@ -254,43 +327,293 @@ def add_hg_segment(powerline, cwd):
         if has_missing_files:
             extra += '!'
         branch += (' ' + extra if extra != '' else '')
-    powerline.append_right(Segment(powerline, ' %s ' % branch, fg, bg, separator=powerline.separator_right, right=True))
-    return True
+    return Segment(powerline, ' %s ' % branch, fg, bg, separator=powerline.separator_right, right=True)
+
+
+def _which(program):
+    for path in os.getenv('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
 
 
-def get_git_status():
-    has_pending_commits = True
+def _runtime_socket(name):
+    """ Returns where the socket called name lives: $XDG_RUNTIME_DIR, or
+        else a directory of our own under $TMPDIR. Returns None when that
+        directory exists but isn't private to us.
+    """
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = os.path.join(os.getenv('TMPDIR') or '/tmp',
+                'powerline-shell-%d' % os.getuid())
+        try:
+            os.mkdir(runtime_dir, 0o700)
+        except OSError:
+            pass
+        try:
+            st = os.lstat(runtime_dir)
+        except OSError:
+            return None
+        # Anyone who can put a socket in there can write our prompt
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+                or st.st_mode & 0o077:
+            return None
+    return os.path.join(runtime_dir, '%s.sock' % name)
+
+
+def _recv_record(recv):
+    """ Reads one \\x1e terminated gitstatusd record, or returns b'' if the
+        other end went away first.
+    """
+    record = b''
+    while not record.endswith(b'\x1e'):
+        chunk = recv(4096)
+        if not chunk:
+            return b''
+        record += chunk
+    return record
+
+
+def _ask_gitstatusd(daemon, request):
+    """ Relays one request to the bridge's gitstatusd. Returns its response,
+        or b'' once gitstatusd has died or stopped answering.
+    """
+    import select
+    if daemon.poll() is not None:
+        return b''
+    stdout = daemon.stdout.fileno()
+    deadline = time.time() + GITSTATUSD_REPLY_TIMEOUT
+    def recv(n):
+        # Keep waiting even after the client gave up, as long as gitstatusd
+        # is still alive
+        while not select.select([stdout], [], [], 1)[0]:
+            if daemon.poll() is not None or time.time() > deadline:
+                return b''
+        return os.read(stdout, n)
+    try:
+        daemon.stdin.write(request)
+        daemon.stdin.flush()
+        return _recv_record(recv)
+    except (IOError, OSError):
+        return b''
+
+
+def _serve_gitstatusd(server, daemon):
+    import socket
+    server.settimeout(GITSTATUSD_IDLE_TIMEOUT)
+    while True:
+        try:
+            conn = server.accept()[0]
+        except socket.timeout:
+            return
+        conn.settimeout(GITSTATUSD_TIMEOUT)
+        try:
+            try:
+                request = _recv_record(conn.recv)
+            except socket.error:
+                continue
+            if not request:
+                continue
+            response = _ask_gitstatusd(daemon, request)
+            if not response:
+                # Shut the bridge down so the next prompt starts a fresh one
+                return
+            try:
+                conn.sendall(response)
+            except socket.error:
+                pass
+        finally:
+            conn.close()
+
+
+def _spawn_gitstatusd(path):
+    """ Forks a detached bridge that runs gitstatusd and relays requests
+        from the socket at path to it. Returns whether the bridge came up.
+    """
+    import fcntl
+    import socket
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(ready_r)
+            os.setsid()
+            # Fork again so the bridge is left to init to reap, even when
+            # the caller is a long running --serve process
+            if os.fork():
+                os._exit(0)
+            os.chdir('/')
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            # Don't keep a --serve client's connection open past its reply
+            try:
+                maxfd = os.sysconf('SC_OPEN_MAX')
+            except (AttributeError, ValueError):
+                maxfd = 256
+            os.closerange(3, ready_w)
+            os.closerange(ready_w + 1, maxfd)
+
+            # One bridge per socket. When prompts race to start one, the
+            # losers leave the socket to the winner, and the winner keeps
+            # the lock until it has removed its socket again.
+            lock = os.open(path + '.lock', os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.write(ready_w, b'.')
+                os._exit(0)
+
+            daemon = subprocess.Popen(GITSTATUSD_COMMAND,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    close_fds=True)
+            # Bind under a temporary name and move it into place, which also
+            # replaces a socket left behind by a bridge that was killed
+            tmp = '%s.%d' % (path, os.getpid())
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(tmp)
+            server.listen(8)
+            os.rename(tmp, path)
+            os.write(ready_w, b'.')
+            os.close(ready_w)
+            try:
+                _serve_gitstatusd(server, daemon)
+            finally:
+                os.unlink(path)
+                daemon.kill()
+                daemon.wait()
+        finally:
+            os._exit(0)
+
+    os.close(ready_w)
+    os.waitpid(pid, 0)
+    ready = os.read(ready_r, 1)
+    os.close(ready_r)
+    return bool(ready)
+
+
+def _query_gitstatusd(cwd):
+    """ Asks gitstatusd about the repository at cwd, starting it if needed.
+        Returns the response fields, or None when gitstatusd isn't
+        installed, didn't answer in time or sent something we won't put in
+        the prompt.
+    """
+    if not _which(GITSTATUSD_COMMAND[0]):
+        return None
+    path = _runtime_socket('powerline-gitstatusd')
+    if path is None:
+        return None
+    # Only pay for the import when there's a gitstatusd to talk to
+    import socket
+    request = (u'%d\x1f%s\x1e' % (os.getpid(), cwd)).encode('utf-8')
+    for attempt in range(2):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(GITSTATUSD_TIMEOUT)
+        try:
+            if os.lstat(path).st_uid != os.getuid():
+                sock.close()
+                return None
+        except OSError:
+            pass
+        try:
+            sock.connect(path)
+        except socket.error:
+            sock.close()
+            if attempt or not _which(GITSTATUSD_COMMAND[0]) \
+                    or not _spawn_gitstatusd(path):
+                return None
+            continue
+        try:
+            sock.sendall(request)
+            response = _recv_record(sock.recv)
+        except socket.error:
+            return None
+        finally:
+            sock.close()
+        if not response:
+            return None
+        fields = response[:-1].decode('utf-8').split(u'\x1f')
+        if len(fields) < 2 or fields[1] == u'1' and (len(fields) < 16
+                or not _prompt_safe(fields[3] + fields[4])
+                or not all(f.isdigit() for f in fields[10:16])):
+            return None
+        return fields
+    return None
+
+
+def _prompt_safe(text):
+    """ Whether text can go into PS1 as is, without bash or zsh expanding
+        any of it.
+    """
+    return not any(c in u'$`\\%' or c < u' ' for c in text)
+
+
+def _origin_position(ahead, behind):
+    origin_position = ""
+    if ahead > 0:
+        origin_position += " %d" % ahead + u'\u21E1'
+    if behind > 0:
+        origin_position += " %d" % behind + u'\u21E3'
+    return origin_position
+
+
+def get_git_status(cwd):
+    fields = _query_gitstatusd(cwd)
+    if fields is not None:
+        if fields[1] != '1':
+            return None, False, False, ""
+        # See gitstatusd's docs for the full list of response fields
+        commit, branch = fields[3], fields[4]
+        if not branch and commit:
+            branch = '(HEAD detached at %s)' % commit[:7]
+        staged, unstaged, conflicted, untracked = \
+                [int(f) for f in fields[10:14]]
+        return (branch, bool(staged or unstaged or conflicted or untracked),
+                bool(untracked),
+                _origin_position(int(fields[14]), int(fields[15])))
+
+    branch = None
+    oid = ''
+    has_pending_commits = False
     has_untracked_files = False
     origin_position = ""
-    output = subprocess.Popen(['git', 'status'],
-            stdout=subprocess.PIPE).communicate()[0].decode('utf-8')
-    for line in output.split('\n'):
-        origin_status = re.findall(
-                r"Your branch is (ahead|behind).*?(\d+) comm", line)
-        if origin_status:
-            origin_position = " %d" % int(origin_status[0][1])
-            if origin_status[0][0] == 'behind':
-                origin_position += u'\u21E3'
-            if origin_status[0][0] == 'ahead':
-                origin_position += u'\u21E1'
-
-        if line.find('nothing to commit') >= 0:
-            has_pending_commits = False
-        if line.find('Untracked files') >= 0:
+    with open(os.devnull, 'wb') as devnull:
+        status = subprocess.Popen(['git', '--no-optional-locks', 'status',
+                '--branch', '--porcelain=v2'], stdout=subprocess.PIPE,
+                stderr=devnull)
+    for line in status.stdout:
+        line = line.decode('utf-8').rstrip('\n')
+        if line.startswith('# branch.oid '):
+            oid = line[13:]
+        elif line.startswith('# branch.head '):
+            branch = line[14:]
+            if branch == '(detached)':
+                branch = '(HEAD detached at %s)' % oid[:7]
+        elif line.startswith('# branch.ab '):
+            ahead, behind = line[12:].split()
+            origin_position = _origin_position(int(ahead), -int(behind))
+        elif line[:1] == '?':
+            # Untracked entries come after all the changed ones, so there's
+            # nothing left to learn from the rest of the listing
             has_untracked_files = True
-    return has_pending_commits, has_untracked_files, origin_position
-
+            has_pending_commits = True
+            break
+        elif line[:1] in ('1', '2', 'u'):
+            has_pending_commits = True
+    status.stdout.close()
+    if status.poll() is None:
+        status.kill()
+    status.wait()
+    return branch, has_pending_commits, has_untracked_files, origin_position
+
+
+def get_git_segment(powerline, cwd, root):
+    branch, has_pending_commits, has_untracked_files, origin_position = \
+            get_git_status(cwd)
+    if not branch:
+        return None
 
-def add_git_segment(powerline, cwd):
-    #cmd = "git branch 2> /dev/null | grep -e '\\*'"
-    p1 = subprocess.Popen(['git', 'branch'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p2 = subprocess.Popen(['grep', '-e', '\\*'], stdin=p1.stdout, stdout=subprocess.PIPE)
-    output = p2.communicate()[0].strip().decode('utf-8')
-    if not output:
-        return False
-
-    branch = output.rstrip()[2:]
-    has_pending_commits, has_untracked_files, origin_position = get_git_status()
     branch += origin_position
     if has_untracked_files:
         branch += ' +'
@@ -301,15 +624,14 @@ def add_git_segment(powerline, cwd):
         bg = Color.REPO_DIRTY_BG
         fg = Color.REPO_DIRTY_FG
 
-    powerline.append_right(Segment(powerline, ' %s ' % branch, fg, bg, separator=powerline.separator_right, right=True))
-    return True
+    return Segment(powerline, ' %s ' % branch, fg, bg, separator=powerline.separator_right, right=True)
 
 
-def add_svn_segment(powerline, cwd):
-    is_svn = subprocess.Popen(['svn', 'status'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    is_svn_output = is_svn.communicate()[1].strip().decode('utf-8')
-    if len(is_svn_output) != 0:
-        return
+def get_svn_segment(powerline, cwd, root):
+    output, error = subprocess.Popen(['svn', 'status'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+    if len(error.strip()) != 0:
+        return None
     '''svn info:
         First column: Says if item was added, deleted, or otherwise changed
         ' ' no modifications
@@ -325,28 +647,22 @@ def add_svn_segment(powerline, cwd):
          '~' versioned item obstructed by some item of a different kind
     '''
     #TODO: Color segment based on above status codes
-    try:
-        #cmd = '"svn status | grep -c "^[ACDIMRX\\!\\~]"'
-        p1 = subprocess.Popen(['svn', 'status'], stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        p2 = subprocess.Popen(['grep', '-c', '^[ACDIMR\\!\\~]'],
-                stdin=p1.stdout, stdout=subprocess.PIPE)
-        output = p2.communicate()[0].strip().decode('utf-8')
-        if len(output) > 0 and int(output) > 0:
-            changes = output.strip()
-            powerline.append(Segment(powerline, ' %s ' % changes,
-                Color.SVN_CHANGES_FG, Color.SVN_CHANGES_BG))
-    except OSError:
-        return False
-    except subprocess.CalledProcessError:
-        return False
-    return True
+    changes = sum(1 for line in output.decode('utf-8').splitlines()
+            if line[:1] and line[:1] in 'ACDIMR!~')
+    if changes == 0:
+        return None
+    return Segment(powerline, ' %s ' % changes, Color.SVN_CHANGES_FG,
+            Color.SVN_CHANGES_BG)
+
+# Same as strftime's %a in the C locale Python starts out in
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
 
 def add_time_segment(powerline, cwd):
         
     now = datetime.datetime.now()
     #stuff = " %d:%d:%d %d.%d.%d " % (now.hour, now.minute, now.second, now.day, now.month, now.year)
-    stuff = " %s " % now.strftime("%a %d %H:%M:%S")
+    stuff = " %s %02d %02d:%02d:%02d " % (WEEKDAYS[now.weekday()], now.day,
+            now.hour, now.minute, now.second)
     
     powerline.append_right(Segment(powerline, stuff, Color.TIME_FG, Color.TIME_BG, separator=powerline.separator_right, right=True))
     return True
@@ -365,17 +681,307 @@ def add_extra_segment(powerline, cwd, extra, color=Color.EXTRA_FG, nol=False):
     powerline.append_right(Segment(powerline, stuff, color, Color.EXTRA_BG, separator=sep, separator_fg=sepc, right=True))
     return True
 
-def add_repo_segment(powerline, cwd):
-    for add_repo_segment in (add_git_segment, add_svn_segment, add_hg_segment):
+def _find_vcs_root(cwd, kinds=('git', 'svn', 'hg')):
+    """ Walk up from cwd looking for a VCS directory of one of the given
+        kinds. Returns a (vcs, root) tuple, or None when cwd isn't inside
+        such a repository.
+    """
+    path = cwd
+    while True:
+        for vcs in kinds:
+            try:
+                if os.path.exists(os.path.join(path, '.' + vcs)):
+                    return vcs, path
+            except UnicodeError:
+                # Python 2 can't stat a non-ASCII path under a C locale, so
+                # carry on with the parents it can stat
+                break
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _git_dir(root):
+    git_dir = os.path.join(root, '.git')
+    if os.path.isfile(git_dir):
+        # Worktrees and submodules point at the real git dir
+        with open(git_dir) as f:
+            line = f.read().strip()
+        if line.startswith('gitdir: '):
+            git_dir = os.path.join(root, line[8:])
+    return git_dir
+
+
+def _git_common_dir(git_dir):
+    """ Returns the directory holding refs and packed-refs, which for a
+        linked worktree is the main repository's git dir.
+    """
+    try:
+        with open(os.path.join(git_dir, 'commondir')) as f:
+            common_dir = f.read().strip()
+    except IOError:
+        return git_dir
+    return os.path.join(git_dir, common_dir)
+
+
+def _read_head(git_dir):
+    """ Returns a (ref, name) tuple for the checked out HEAD. ref is None
+        and name the abbreviated commit when HEAD is detached, and both are
+        None when HEAD can't be read.
+    """
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().rstrip()
+    except IOError:
+        return None, None
+    if head.startswith('ref: '):
+        ref = head[5:]
+        if ref.startswith('refs/heads/'):
+            return ref, ref[11:]
+        return ref, ref
+    return None, head[:7] or None
+
+
+def _repo_fingerprint(vcs, root):
+    if vcs == 'git':
+        vcs_dir = _git_dir(root)
+    else:
+        vcs_dir = os.path.join(root, '.' + vcs)
+    names = list(VCS_FINGERPRINT_FILES[vcs])
+    if vcs == 'git':
+        # os.path.join keeps these absolute paths as they are
+        common_dir = _git_common_dir(vcs_dir)
+        names.append(os.path.join(common_dir, 'packed-refs'))
+        ref = _read_head(vcs_dir)[0]
+        if ref:
+            names.append(os.path.join(common_dir, ref))
+
+    parts = [vcs, root]
+    for name in names:
         try:
-            if add_repo_segment(p, cwd):
-                return
-        except subprocess.CalledProcessError:
+            st = os.stat(os.path.join(vcs_dir, name))
+        except OSError:
+            parts.append('-')
+            continue
+        parts.append('%s:%s' % (getattr(st, 'st_mtime_ns', st.st_mtime),
+            st.st_size))
+    return ' '.join(parts)
+
+
+def _repo_cache_file(cwd):
+    """ Returns the cache file for cwd, or None when there's neither
+        $XDG_CACHE_HOME nor $HOME to keep it in.
+    """
+    cache_home = os.getenv('XDG_CACHE_HOME')
+    if not cache_home:
+        if not HOME:
+            return None
+        cache_home = os.path.join(HOME, '.cache')
+    key = '%08x' % (zlib.crc32(cwd.encode('utf-8')) & 0xffffffff)
+    return os.path.join(cache_home, 'powerline-shell', key)
+
+
+def _dump_segments(segments):
+    return [u'%d\t%s\t%s\t%s' % (segment.right, segment.fg, segment.bg,
+        segment.content) for segment in segments]
+
+
+def _load_segments(lines):
+    """ Turns lines written by _dump_segments back into (right, content, fg,
+        bg) tuples.
+    """
+    segments = []
+    for line in lines:
+        right, fg, bg, content = line.split('\t', 3)
+        segments.append((right == '1', content, int(fg), int(bg)))
+    return segments
+
+
+def _append_segments(powerline, segments):
+    for right, content, fg, bg in segments:
+        if right:
+            powerline.append_right(Segment(powerline, content, fg, bg,
+                separator=powerline.separator_right, right=True))
+        else:
+            powerline.append(Segment(powerline, content, fg, bg))
+
+
+def _repo_cache_lookup(path, fingerprint):
+    """ Returns the cached (right, content, fg, bg) tuples for path, or None
+        when the cache is missing, stale or was written for another
+        fingerprint.
+    """
+    if path is None:
+        return None
+    try:
+        if time.time() - os.stat(path).st_mtime >= REPO_CACHE_TTL:
+            return None
+        with io.open(path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+    if not lines or lines[0] != fingerprint:
+        return None
+    return _load_segments(lines[1:])
+
+
+def _prune_repo_cache(cache_dir):
+    """ Drops cache files (and temp files of killed writers) that are past
+        REPO_CACHE_TTL and so can never be hit again. This keeps the cache
+        down to the directories visited in the last few seconds.
+    """
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        try:
+            if now - os.stat(entry).st_mtime >= REPO_CACHE_TTL:
+                os.unlink(entry)
+        except OSError:
             pass
+
+
+def _repo_cache_store(path, fingerprint, segments):
+    if path is None:
+        return
+    lines = [fingerprint] + _dump_segments(segments)
+    tmp = '%s.%d' % (path, os.getpid())
+    try:
+        cache_dir = os.path.dirname(path)
+        if os.path.isdir(cache_dir):
+            _prune_repo_cache(cache_dir)
+        else:
+            os.makedirs(cache_dir)
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(lines) + u'\n')
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp)
         except OSError:
             pass
 
 
+# Segment builders by VCS, called as (powerline, cwd, root) with the root
+# _find_vcs_root found for cwd
+REPO_SEGMENTS = {
+    'git': get_git_segment,
+    'svn': get_svn_segment,
+    'hg': get_hg_segment,
+}
+
+
+def _repo_cache(cwd, root):
+    """ Returns the (cache file, fingerprint) pair for cwd inside the
+        repository found by _find_vcs_root.
+    """
+    # cwd is part of the fingerprint too, in case two directories share a
+    # cache file name
+    return _repo_cache_file(cwd), u'%s %s' % (cwd, _repo_fingerprint(*root))
+
+
+def add_repo_segment(powerline, cwd):
+    # Only run the VCS that owns cwd, and nothing at all outside a repo
+    root = _find_vcs_root(cwd)
+    if root is None:
+        return
+
+    cache, fingerprint = _repo_cache(cwd, root)
+    cached = _repo_cache_lookup(cache, fingerprint)
+    if cached is not None:
+        _append_segments(powerline, cached)
+        return
+
+    segment = None
+    try:
+        segment = REPO_SEGMENTS[root[0]](powerline, cwd, root[1])
+    except subprocess.CalledProcessError:
+        pass
+    except OSError:
+        pass
+    if segment is not None:
+        if segment.right:
+            powerline.append_right(segment)
+        else:
+            powerline.append(segment)
+
+    _repo_cache_store(cache, fingerprint, [segment] if segment else [])
+
+
+def add_async_repo_segment(powerline, cwd, args):
+    """ Like add_repo_segment, but only waits ASYNC_REPO_TIMEOUT seconds for
+        the VCS commands. Past that a placeholder is drawn instead, and a
+        forked child repaints the first prompt line on the terminal once the
+        real segment has been worked out.
+    """
+    root = _find_vcs_root(cwd)
+    if root is None or _repo_cache_lookup(*_repo_cache(cwd, root)) is not None:
+        add_repo_segment(powerline, cwd)
+        return
+    try:
+        tty = os.open('/dev/tty', os.O_RDONLY)
+    except OSError:
+        # Nowhere to repaint the prompt later
+        add_repo_segment(powerline, cwd)
+        return
+    try:
+        pgrp = os.tcgetpgrp(tty)
+    finally:
+        os.close(tty)
+
+    import socket
+    parent_sock, child_sock = socket.socketpair()
+    sys.stdout.flush()
+    if os.fork() == 0:
+        try:
+            parent_sock.close()
+            # Let go of the shell's command substitution pipe
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+
+            scratch = Powerline(mode=args.mode, shell='bare')
+            add_repo_segment(scratch, cwd)
+            lines = _dump_segments(scratch.segments + scratch.segments_right)
+            try:
+                child_sock.sendall(
+                        (u'\n'.join(lines) + u'\x1e').encode('utf-8'))
+                accepted = child_sock.recv(1)
+            except socket.error:
+                accepted = b''
+            if not accepted:
+                # Give the shell a moment to print the prompt we repaint
+                time.sleep(ASYNC_REPO_TIMEOUT)
+                redraw_prompt(cwd, args, _load_segments(lines), pgrp)
+        finally:
+            os._exit(0)
+
+    child_sock.close()
+    parent_sock.settimeout(ASYNC_REPO_TIMEOUT)
+    try:
+        record = _recv_record(parent_sock.recv)
+        if record:
+            parent_sock.sendall(b'.')
+    except socket.error:
+        record = b''
+    parent_sock.close()
+
+    if record:
+        lines = record[:-1].decode('utf-8').split(u'\n')
+        _append_segments(powerline, _load_segments(l for l in lines if l))
+        return
+
+    # The branch is one file read away, only the status has to wait
+    branch = None
+    if root[0] == 'git':
+        branch = _read_head(_git_dir(root[1]))[1]
+    placeholder = u' %s \u2026 ' % branch if branch else u' \u2026 '
+    # Neutral colors: the tree is neither clean nor dirty until we know
+    powerline.append_right(Segment(powerline, placeholder,
+        Color.PATH_FG, Color.PATH_BG,
+        separator=powerline.separator_right, right=True))
+
+
 def add_virtual_env_segment(powerline, cwd):
     env = os.getenv("VIRTUAL_ENV")
     if env is None:
@@ -421,41 +1027,219 @@ def get_valid_cwd():
         warn("Your current directory is invalid. Lowest valid directory: " + up)
     return cwd
 
-if __name__ == '__main__':
-    arg_parser = argparse.ArgumentParser()
-    arg_parser.add_argument('--cwd-only', action='store_true')
-    arg_parser.add_argument('--mode', action='store', default='patched')
-    arg_parser.add_argument('--extra', action='store', default='')
-    arg_parser.add_argument('--shell', action='store', default='bash')
-    arg_parser.add_argument('--width', action='store', default=0)
-    arg_parser.add_argument('--chroot', action='store', default=0)
-    arg_parser.add_argument('prev_error', nargs='?', default=0)
-    
-    args = arg_parser.parse_args()
+def build_prompt(powerline, cwd, args, async_repo=False, repo_segments=None):
+    add_virtual_env_segment(powerline, cwd)
+    #powerline.append(Segment(powerline, ' \\u ', 250, 240))
+    #powerline.append(Segment(powerline, ' \\h ', 250, 238))
+    add_cwd_segment(powerline, cwd, 4, args.cwd_only)
 
-    p = Powerline(mode=args.mode, shell=args.shell, width=args.width)
-    cwd = get_valid_cwd()
-    add_virtual_env_segment(p, cwd)
-    #p.append(Segment(p, ' \\u ', 250, 240))
-    #p.append(Segment(p, ' \\h ', 250, 238))
-    add_cwd_segment(p, cwd, 4, args.cwd_only)
-    
-    add_time_segment(p, cwd)
+    add_time_segment(powerline, cwd)
     if len(args.extra)>0:
         if args.chroot == "1":
-            add_extra_segment(p, cwd, args.extra, nol=True)
+            add_extra_segment(powerline, cwd, args.extra, nol=True)
         else:
-            add_extra_segment(p, cwd, args.extra)
+            add_extra_segment(powerline, cwd, args.extra)
 
     if args.chroot == "1":
-        add_extra_segment(p, cwd, "CHROOT")
+        add_extra_segment(powerline, cwd, "CHROOT")
 
-    add_repo_segment(p, cwd)
-    
-    add_root_indicator(p, args.prev_error)
+    if repo_segments is not None:
+        _append_segments(powerline, repo_segments)
+    elif async_repo:
+        add_async_repo_segment(powerline, cwd, args)
+    else:
+        add_repo_segment(powerline, cwd)
+
+    add_root_indicator(powerline, args.prev_error)
+
+
+def redraw_prompt(cwd, args, repo_segments, pgrp):
+    """ Repaints the first line of an already printed prompt, leaving the
+        cursor where it was on the input line below. Does nothing once the
+        terminal has moved on to another foreground process group, as the
+        prompt is no longer where we left it.
+    """
+    powerline = Powerline(mode=args.mode, shell='bare', width=args.width)
+    build_prompt(powerline, cwd, args, repo_segments=repo_segments)
+    top = powerline.draw().split('\n', 1)[0]
+    with io.open('/dev/tty', 'w', encoding='utf-8') as tty:
+        if os.tcgetpgrp(tty.fileno()) != pgrp:
+            return
+        tty.write(u'\x1b7\x1b[A\r' + top + u'\x1b[K\x1b8')
+
+
+def render_prompt(cwd, args):
+    powerline = Powerline(mode=args.mode, shell=args.shell, width=args.width)
+    build_prompt(powerline, cwd, args, args.async_repo)
+    return powerline.draw()
+
+
+def _handle_prompt_request(request):
+    """ A request is a NUL separated list of the client's cwd, its
+        VIRTUAL_ENV (possibly empty) and then the usual command line
+        arguments.
+    """
+    fields = request.decode('utf-8').split(u'\0')
+    if fields[-1] == u'':
+        fields.pop()
+    if len(fields) < 2 or not os.path.isabs(fields[0]):
+        return u''
+    cwd, virtual_env = fields[:2]
+    try:
+        args = parse_args(fields[2:])
+    except SystemExit:
+        return u''
+    # The child would hold on to the client's connection until it's done
+    args.async_repo = False
+
+    if virtual_env:
+        _os.environ['VIRTUAL_ENV'] = virtual_env
+    else:
+        _os.environ.pop('VIRTUAL_ENV', None)
+    up = cwd
+    while not os.path.isdir(up):
+        up = os.path.dirname(up)
+    os.chdir(up)
+    return render_prompt(cwd, args)
+
+
+def serve():
+    """ Keeps a prompt server running on the powerline-shell socket (see
+        _runtime_socket), which saves clients the interpreter startup on
+        every prompt.
+    """
+    import signal
+    import socket
+    import traceback
+    path = _runtime_socket('powerline-shell')
+    if path is None:
+        warn("No private directory for the prompt server's socket")
+        sys.exit(1)
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # Left behind by a server that didn't shut down cleanly
+            os.unlink(path)
+        else:
+            warn("A prompt server is already running on " + path)
+            sys.exit(1)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            conn = server.accept()[0]
+            conn.settimeout(SERVE_CLIENT_TIMEOUT)
+            try:
+                request = b''
+                chunk = conn.recv(4096)
+                while chunk:
+                    request += chunk
+                    chunk = conn.recv(4096)
+                conn.sendall(_handle_prompt_request(request).encode('utf-8'))
+            except socket.error:
+                # The client went away, or never sent a whole request
+                pass
+            except Exception:
+                # The client gets an empty reply and falls back to running
+                # the script itself
+                traceback.print_exc()
+            finally:
+                conn.close()
+    finally:
+        os.unlink(path)
+
+
+# Command line options taking a value, and their defaults
+ARG_OPTIONS = {
+    '--mode': ('mode', 'patched'),
+    '--extra': ('extra', ''),
+    '--shell': ('shell', 'bash'),
+    '--width': ('width', 0),
+    '--chroot': ('chroot', 0),
+}
+
+ARG_FLAGS = {
+    '--cwd-only': 'cwd_only',
+    '--async': 'async_repo',
+    '--serve': 'serve',
+}
+
+
+class Arguments(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _parse_args_slow(argv):
+    # Only needed for --help and bad command lines, and costs more to
+    # import than parsing the usual arguments takes
+    import argparse
+    arg_parser = argparse.ArgumentParser()
+    for option, dest in sorted(ARG_FLAGS.items()):
+        arg_parser.add_argument(option, action='store_true', dest=dest)
+    for option, (dest, default) in sorted(ARG_OPTIONS.items()):
+        arg_parser.add_argument(option, action='store', dest=dest,
+                default=default)
+    arg_parser.add_argument('prev_error', nargs='?', default=0)
+    return arg_parser.parse_args(argv)
+
+
+def parse_args(argv=None):
+    """ Parses the arguments a prompt normally passes by hand. Anything else
+        goes to argparse, which prints help and errors the usual way.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    args = Arguments(prev_error=0, **dict(ARG_OPTIONS.values()))
+    for dest in ARG_FLAGS.values():
+        setattr(args, dest, False)
+
+    seen_prev_error = False
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        option, has_value, value = arg.partition('=')
+        if arg in ARG_FLAGS:
+            setattr(args, ARG_FLAGS[arg], True)
+        elif option in ARG_OPTIONS:
+            if not has_value:
+                i += 1
+                if i == len(argv):
+                    return _parse_args_slow(argv)
+                value = argv[i]
+            setattr(args, ARG_OPTIONS[option][0], value)
+        elif not arg.startswith('-') and not seen_prev_error:
+            args.prev_error = arg
+            seen_prev_error = True
+        else:
+            return _parse_args_slow(argv)
+        i += 1
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.serve:
+        serve()
+        sys.exit(0)
+
+    cwd = get_valid_cwd()
+    prompt = render_prompt(cwd, args).encode('utf-8')
     if sys.version_info >= (3, 0):
-        sys.stdout.write(p.draw())
+        # Skip the text layer, but flush anything warn() left in it first
+        sys.stdout.flush()
+        sys.stdout.buffer.write(prompt)
     else:
-        sys.stdout.write(p.draw().encode('utf-8'))
+        sys.stdout.write(prompt)
+
+
+if __name__ == '__main__':
+    main()
 
 # vim: set expandtab: